@@ -11,7 +11,7 @@ warnings.simplefilter('ignore', Image.DecompressionBombWarning)
 
 class Animator():
     @classmethod
-    def format_images(cls, tif_path, region, dates, video_path, xml_path, name, res, img_format):
+    def format_images(cls, tif_path, region, dates, video_path, xml_path, name, res, img_format, originals_format=None):
         width, height = region.calculate_width_height(res)
         if width * height > 2 * Image.MAX_IMAGE_PIXELS:
             print("The downloaded images are too large to generate a video. Redownloading the region with smaller image dimensions")
@@ -23,7 +23,7 @@ class Animator():
                 TiffDownloader.download_area_tiff(region, date, xml_path, frame_name, name, res, img_format, width=resized_width, height=resized_height)
             
         else:
-            images = [img for img in os.listdir(tif_path) if img.endswith(img_format)]
+            images = [img for img in os.listdir(tif_path) if img.endswith(originals_format or img_format)]
             for image in images:
                 frame_output = os.path.splitext(os.path.join(video_path, image))[0] + "." + img_format
                 if not os.path.exists(frame_output):
@@ -4,6 +4,17 @@ import numpy as np
 import pyproj
 from pyproj import Proj, Transformer
 
+# Constants for MODIS grid tile conversion
+CELLS = 2400
+VERTICAL_TILES = 18
+HORIZONTAL_TILES = 36
+EARTH_RADIUS = 6371007.181
+EARTH_WIDTH = 2 * math.pi * EARTH_RADIUS
+TILE_WIDTH = EARTH_WIDTH / HORIZONTAL_TILES
+TILE_HEIGHT = TILE_WIDTH
+CELL_SIZE = TILE_WIDTH / CELLS
+MODIS_GRID = Proj(f'+proj=sinu +R={EARTH_RADIUS} +nadgrids=@null +wktext') # built once, rather than for every tile
+
 # stores coordinate information 
 class Coordinate():
     def __init__(self, coords):
@@ -38,7 +49,7 @@ class Rectangle():
         resolution: represents the pixel resolution, i.e. km/pixel. Should be a value from this list: [0.03, 0.06, 0.125, 0.25, 0.5, 1, 5, 10]
         """
         KM_PER_DEG_AT_EQ = 111.
-        km_per_deg_at_lat = KM_PER_DEG_AT_EQ * np.cos(np.pi * np.mean([self.bl_coords.y, self.tr_coords.y]) / 180.)
+        km_per_deg_at_lat = KM_PER_DEG_AT_EQ * math.cos(math.radians((self.bl_coords.y + self.tr_coords.y) / 2)) # scalar math, no array round trip
         width = int((self.tr_coords.x - self.bl_coords.x) * km_per_deg_at_lat / resolution)
         height = int((self.tr_coords.y - self.bl_coords.y) * KM_PER_DEG_AT_EQ / resolution)
         return (width, height)
@@ -47,19 +58,17 @@ class Rectangle():
     # Taken from #https://gis.stackexchange.com/questions/265400/getting-tile-number-of-sinusoidal-modis-product-from-lat-long 
     # All credit to user @renatoc
     def lat_lon_to_modis(self):
-        # Constants for MODIS grid tile conversion
-        CELLS = 2400
-        VERTICAL_TILES = 18
-        HORIZONTAL_TILES = 36
-        EARTH_RADIUS = 6371007.181
-        EARTH_WIDTH = 2 * math.pi * EARTH_RADIUS
-        TILE_WIDTH = EARTH_WIDTH / HORIZONTAL_TILES
-        TILE_HEIGHT = TILE_WIDTH
-        CELL_SIZE = TILE_WIDTH / CELLS
-        MODIS_GRID = Proj(f'+proj=sinu +R={EARTH_RADIUS} +nadgrids=@null +wktext')
-        
         x, y = MODIS_GRID(self.bl_coords.x, self.bl_coords.y)
         h = (EARTH_WIDTH * .5 + x) / TILE_WIDTH
         v = -(EARTH_WIDTH * .25 + y - (VERTICAL_TILES - 0) * TILE_HEIGHT) / TILE_HEIGHT
 
-        return 'h{}v{}'.format(str(f'{int(h):02d}'), str(f'{int(v):02d}'))
\ No newline at end of file
+        return 'h{}v{}'.format(str(f'{int(h):02d}'), str(f'{int(v):02d}'))
+
+    # Same as lat_lon_to_modis for many bottom left corners at once, projecting them in a single call
+    @classmethod
+    def lat_lon_to_modis_cells(cls, lons, lats):
+        x, y = MODIS_GRID(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        h = (EARTH_WIDTH * .5 + x) / TILE_WIDTH
+        v = -(EARTH_WIDTH * .25 + y - (VERTICAL_TILES - 0) * TILE_HEIGHT) / TILE_HEIGHT
+
+        return ['h{:02d}v{:02d}'.format(h_cell, v_cell) for h_cell, v_cell in zip(np.trunc(h).astype(int).tolist(), np.trunc(v).astype(int).tolist())]
@@ -1,33 +1,45 @@
 import os
+import re
 
-from GIBSDownloader.coordinate_utils import Rectangle
+from GIBSDownloader.coordinate_utils import Coordinate, Rectangle
 from GIBSDownloader.product import Product
 
+# "2020-09-15_038.1579,-121.3758,037.0042,-122.8529.jpeg"
+TILE_FILENAME_RE = re.compile(r'(\d{4}-\d{2}-\d{2})_(-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\.\w+$')
+# "VIIRS-SNPP-CorrectedReflectance-TrueColor_2020-09-15.jpeg"
+TIFF_FILENAME_RE = re.compile(r'(.+)_(\d{4}-\d{2}-\d{2})\.\w+$')
+# "00012_0_13056_13056_26112.jpeg" (index, start x, start y, end x, end y)
+INTERMEDIATE_FILENAME_RE = re.compile(r'\d+_(\d+)_(\d+)_(\d+)_(\d+)\.\w+$')
+
 class TileMetadata():
+    __slots__ = ('date', 'region')
+
     def __init__(self, tile_path):
-        filename = os.path.basename(tile_path)
-        components = filename.split('_')
-        date_str = components[0] # "2020-09-15"
-        region_str = os.path.splitext(components[1])[0] # "038.1579,-121.3758,037.0042,-122.8529"
-        region = Rectangle.from_str(region_str)
+        match = TILE_FILENAME_RE.match(os.path.basename(tile_path))
+        if match is None:
+            raise ValueError("Unrecognized tile filename: {}".format(tile_path))
+        date_str, bl_y, bl_x, tr_y, tr_x = match.groups()
         self.date = date_str
-        self.region = region
+        self.region = Rectangle(Coordinate((float(bl_y), float(bl_x))), Coordinate((float(tr_y), float(tr_x))))
 
 class TiffMetadata():
+    __slots__ = ('name', 'product_name', 'date')
+
     def __init__(self, tiff_path):
         filename = os.path.basename(tiff_path)
-        components = filename.split('_')
-        date = os.path.splitext(components[1])[0]
+        match = TIFF_FILENAME_RE.match(filename)
+        if match is None:
+            raise ValueError("Unrecognized image filename: {}".format(tiff_path))
         self.name = filename
-        self.date = date
-        self.product_name = components[0]
+        self.product_name, self.date = match.groups()
 
 class IntermediateMetadata():
+    __slots__ = ('name', 'start_x', 'start_y', 'end_x', 'end_y')
+
     def __init__(self, inter_path):
         filename = os.path.basename(inter_path)
-        components = filename.split("_")
+        match = INTERMEDIATE_FILENAME_RE.match(filename)
+        if match is None:
+            raise ValueError("Unrecognized intermediate image filename: {}".format(inter_path))
         self.name = filename
-        self.start_x = int(components[1])
-        self.start_y = int(components[2])
-        self.end_x = int(components[3])
-        self.end_y = int(os.path.splitext(components[4])[0])
\ No newline at end of file
+        self.start_x, self.start_y, self.end_x, self.end_y = map(int, match.groups())
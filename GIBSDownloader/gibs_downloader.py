@@ -3,7 +3,9 @@ import os
 import shutil
 import argparse
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 from PIL import Image
 
 from GIBSDownloader.coordinate_utils import Coordinate, Rectangle
@@ -11,7 +13,7 @@ from GIBSDownloader.tile import Tile
 from GIBSDownloader.handling import Handling
 from GIBSDownloader.product import Product
 from GIBSDownloader.tile_utils import TileUtils
-from GIBSDownloader.tiff_downloader import TiffDownloader
+from GIBSDownloader.tiff_downloader import TiffDownloader, MAX_DOWNLOAD_WORKERS
 from GIBSDownloader.file_metadata import TiffMetadata
 from GIBSDownloader.animator import Animator
 from GIBSDownloader.dataset_searcher import DatasetSearcher
@@ -20,50 +22,115 @@ def generate_download_path(start_date, end_date, bl_coords, output, name):
     base = "{name}_{lower_lat}_{lft_lon}_{st_date}-{end_date}".format(name=name.replace(" ","-"), lower_lat=str(round(bl_coords.y, 4)), lft_lon=str(round(bl_coords.x, 4)), st_date=start_date.replace('-',''), end_date=end_date.replace('-', ''))
     return os.path.join(output, base)
 
-def download_originals(download_path, xml_path, originals_path, tiled_path, tfrecords_path, dates, logging, region, name, res, img_format):
-    if not os.path.isdir(download_path):
-        os.mkdir(download_path)
-        os.mkdir(originals_path)
-        os.mkdir(tiled_path)
-        os.mkdir(tfrecords_path)
-
-    if not os.path.isdir(xml_path):
-        os.mkdir(xml_path)
-
-    for date in dates:
-        tiff_output = TiffDownloader.generate_download_filename(originals_path, name.replace(" ","-"), date)
-        if not os.path.isfile(tiff_output + '.' + img_format):
-            if logging:
-                print('Downloading:', date)
-            TiffDownloader.download_area_tiff(region, date.strftime("%Y-%m-%d"), xml_path, tiff_output, name, res, img_format)
-            
+def make_directories(download_path, xml_path, originals_path, tiled_path, tfrecords_path):
+    for path in (download_path, originals_path, tiled_path, tfrecords_path, xml_path):
+        os.makedirs(path, exist_ok=True)
+
+def download_originals(xml_path, originals_path, dates, logging, region, name, res, img_format, cog):
+    TiffDownloader.download_range(region, dates, xml_path, originals_path, name, res, img_format, logging=logging, cog=cog)
     print("The specified region and set of dates have been downloaded")
 
-def tile_originals(tile_res_path, originals_path, tile, logging, region, res, img_format):
-    if not os.path.isdir(tile_res_path):
-        os.mkdir(tile_res_path)
+def try_mkdir(path):
+    # Creates the directory and reports whether it is new, in a single syscall
+    try:
+        os.mkdir(path)
+        return True
+    except FileExistsError:
+        return False
+
+def _tile_one(tiff_path, region, res, tile, tile_date_path, img_format, mp, num_processes=1):
+    TiffDownloader.configure_gdal() # worker processes may be spawned rather than forked from main
+    TileUtils.img_to_tiles(tiff_path, region, res, tile, tile_date_path, img_format, mp=mp, num_processes=num_processes)
+    return tile_date_path
+
+def tile_originals(tile_res_path, originals_path, tile, logging, region, res, img_format, originals_format):
+    os.makedirs(tile_res_path, exist_ok=True)
 
-    files = [f for f in os.listdir(originals_path) if f.endswith(img_format)]
-    files.sort() # tile in chronological order
-    print(files)
+    files = sorted(entry.name for entry in os.scandir(originals_path) if entry.name.endswith(originals_format) and entry.is_file()) # tile in chronological order
+    if logging:
+        print(files)
 
+    jobs = []
     for count, filename in enumerate(files):
         tiff_path = os.path.join(originals_path, filename) # path to GeoTiff file
         metadata = TiffMetadata(tiff_path)
-        tile_date_path = tile_res_path + metadata.date + '/' # path to tiles for specific date
-        if not os.path.exists(tile_date_path):
-            os.mkdir(tile_date_path)
-            print("Tiling day {} of {}".format(count + 1, len(files)))
-            TileUtils.img_to_tiles(tiff_path, region, res, tile, tile_date_path, img_format)
+        tile_date_path = os.path.join(tile_res_path, metadata.date) # path to tiles for specific date
+        if try_mkdir(tile_date_path):
+            jobs.append((tiff_path, tile_date_path))
         else: 
             print("Tiles for day {} have already been generated. Moving on to the next day".format(count + 1))
+
+    # As many images are tiled at once as there are cores and memory to hold them
+    WIDTH, HEIGHT = region.calculate_width_height(res)
+    num_processes = TileUtils.tiling_processes(WIDTH, HEIGHT, len(jobs))
+    if num_processes == 1:
+        # A single image at a time gets every core through the tile level process pool instead
+        for count, (tiff_path, tile_date_path) in enumerate(jobs):
+            _tile_one(tiff_path, region, res, tile, tile_date_path, img_format, True)
+            print("Tiled day {} of {}".format(count + 1, len(jobs)))
+    elif jobs:
+        # Each date is tiled independently, so several images are tiled at once in separate processes.
+        # The tile level pool is disabled inside them to avoid oversubscribing the cores
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            futures = [executor.submit(_tile_one, tiff_path, region, res, tile, tile_date_path, img_format, False, num_processes) for tiff_path, tile_date_path in jobs]
+            for count, future in enumerate(as_completed(futures)):
+                future.result()
+                print("Tiled day {} of {}".format(count + 1, len(jobs)))
+    print("The specified tiles have been generated")
+
+def tile_originals_cog(tile_cog_path, originals_path, tile, logging, img_format, originals_format):
+    os.makedirs(tile_cog_path, exist_ok=True)
+
+    files = sorted(entry.name for entry in os.scandir(originals_path) if entry.name.endswith(originals_format) and entry.is_file())
+    for count, filename in enumerate(files):
+        metadata = TiffMetadata(filename)
+        cog_path = os.path.join(tile_cog_path, "{}.tif".format(metadata.date))
+        if os.path.exists(cog_path):
+            print("The tiled GeoTiff for day {} has already been generated. Moving on to the next day".format(count + 1))
+            continue
+        if logging:
+            print("Writing", cog_path)
+        TileUtils.img_to_cog(os.path.join(originals_path, filename), tile, cog_path, img_format)
+    print("The specified tiled GeoTiffs have been generated")
+
+def split_downloaded(originals_path, dates, name, originals_format):
+    # Dates whose original is already on disk, and those that still have to be fetched
+    date_strs = np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]'), unit='D')
+    on_disk = np.array([TiffDownloader.is_downloaded("{}.{}".format(TiffDownloader.generate_download_filename(originals_path, name.replace(" ","-"), date), originals_format)) for date in date_strs], dtype=bool)
+    return date_strs[on_disk], date_strs[~on_disk]
+
+def _stream_one(region, date_str, xml_path, name, res, tile, tile_date_path, img_format):
+    TiffDownloader.configure_gdal() # worker processes may be spawned rather than forked from main
+    TileUtils.wms_to_tiles(region, date_str, xml_path, name, res, tile, tile_date_path, img_format)
+    return tile_date_path
+
+def stream_tiles(tile_res_path, xml_path, dates, tile, logging, region, name, res, img_format):
+    # Tiles are cut directly from the WMS source, skipping the write and re-read of the original images
+    os.makedirs(tile_res_path, exist_ok=True)
+    TiffDownloader.generate_xml(xml_path, name) # written once here, so the workers only read it
+
+    jobs = []
+    for count, date_str in enumerate(np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]'), unit='D')):
+        tile_date_path = os.path.join(tile_res_path, date_str) # path to tiles for specific date
+        if try_mkdir(tile_date_path):
+            jobs.append((date_str, tile_date_path))
+        else:
+            print("Tiles for day {} have already been generated. Moving on to the next day".format(count + 1))
+
+    if jobs:
+        # Each date is fetched and tiled independently, so several dates are streamed at once, as many as are downloaded at once.
+        # Overlapping tiles read the same WMS blocks again, these come from GDAL's WMS cache on disk rather than from GIBS
+        with ProcessPoolExecutor(max_workers=max(1, min(os.cpu_count(), MAX_DOWNLOAD_WORKERS, len(jobs)))) as executor:
+            futures = [executor.submit(_stream_one, region, date_str, xml_path, name, res, tile, tile_date_path, img_format) for date_str, tile_date_path in jobs]
+            for count, future in enumerate(as_completed(futures)):
+                future.result()
+                print("Tiled day {} of {}".format(count + 1, len(jobs)))
     print("The specified tiles have been generated")
 
 def tile_to_tfrecords(tile_res_path, tfrecords_res_path, logging, name, img_format):
     from GIBSDownloader.tfrecord_utils import TFRecordUtils
     if os.path.isdir(tile_res_path):
-            if not os.path.isdir(tfrecords_res_path):
-                os.mkdir(tfrecords_res_path)
+            if try_mkdir(tfrecords_res_path):
                 if logging: 
                     print("Writing files at:", tile_res_path, " to TFRecords")
                 TFRecordUtils.write_to_tfrecords(tile_res_path, tfrecords_res_path, name, img_format)
@@ -78,13 +145,11 @@ def remove_originals(originals_path, logging):
     shutil.rmtree(originals_path)
     os.mkdir(originals_path)
 
-def generate_video(originals_path, region, dates, video_path, xml_path, name, res, img_format):
-    if not os.path.isdir(video_path):
-        if not os.path.isdir(xml_path):
-            os.mkdir(xml_path)
+def generate_video(originals_path, region, dates, video_path, xml_path, name, res, img_format, originals_format):
+    if try_mkdir(video_path):
+        os.makedirs(xml_path, exist_ok=True)
         print("Generating video...")
-        os.mkdir(video_path)
-        Animator.format_images(originals_path, region, dates, video_path, xml_path, name, res, img_format)
+        Animator.format_images(originals_path, region, dates, video_path, xml_path, name, res, img_format, originals_format=originals_format)
         Animator.create_video(video_path, img_format)
         print("Video generation has finished!")
     else:
@@ -108,11 +173,14 @@ def main():
     parser.add_argument("--product", default=None, type=Product, help="select the NASA imagery product", choices=list(Product))
     parser.add_argument("--keep-xml", default=False, type=bool, help="preserve the xml files generated to download images")
     parser.add_argument("--animate", default=False, type=bool, help="Generate a timelapse video of the downloaded region")
+    parser.add_argument("--cog", default=False, type=bool, help="store the original images as Cloud Optimized GeoTiffs (not used for days tiled straight from GIBS with --tile and --remove-originals)")
+    parser.add_argument("--tile-cog", default=False, type=bool, help="write one internally tiled Cloud Optimized GeoTiff per day instead of one file per tile (square tiles, a multiple of 16 px)")
     parser.add_argument("--name", default="VIIRS_SNPP_CorrectedReflectance_TrueColor", type=str, help="enter the full name of the NASA imagery product and its image resolution separated by comma")
     
 
     # get the user input
     args = parser.parse_args()
+    TiffDownloader.configure_gdal()
     start_date = args.start_date
     end_date = args.end_date
     output_path = args.output_path
@@ -125,8 +193,11 @@ def main():
     keep_xml = args.keep_xml
     animate = args.animate
     name = args.name
+    cog = args.cog
+    tile_cog = args.tile_cog
     
     name, res, img_format = DatasetSearcher.getProductInfo(name)
+    originals_format = 'tif' if cog else img_format
     
     # get the latitude, longitude values from the user input
     bl_coords = Coordinate([float(i) for i in args.bottom_left_coords.replace(" ","").split(',')])
@@ -137,6 +208,10 @@ def main():
     if (bl_coords.x > tr_coords.x or bl_coords.y > tr_coords.y):
         raise argparse.ArgumentTypeError('Inputted coordinates are invalid: order should be (lower_latitude,left_longitude upper_latitude,right_longitude)')
 
+    # The COG driver only writes square internal tiles whose size is a multiple of 16
+    if tiling and tile_cog and (tile.width != tile.height or tile.width % 16 != 0):
+        raise argparse.ArgumentTypeError('Tile dimensions are invalid for --tile-cog: tile-width and tile-height should be equal and a multiple of 16')
+
     # gets paths for downloads
     download_path = generate_download_path(start_date, end_date, bl_coords, output_path, name)
     xml_path = download_path + '/xml_configs/'
@@ -146,28 +221,42 @@ def main():
     video_path = download_path + '/video/'
     resolution = "{t_width}x{t_height}_{t_overlap}".format(t_width=str(tile.width), t_height=str(tile.height), t_overlap=str(tile.overlap))
     tile_res_path = os.path.join(tiled_path, resolution) + '/'
+    tile_cog_path = os.path.join(tiled_path, "cog_{}".format(tile.width)) + '/'
     tfrecords_res_path = os.path.join(tfrecords_path, resolution) + '/'
 
     # get range of dates
     dates = TiffDownloader.get_dates_range(start_date, end_date)
 
-    download_originals(download_path, xml_path, originals_path, tiled_path, tfrecords_path, dates, logging, region, name, res, img_format)
+    make_directories(download_path, xml_path, originals_path, tiled_path, tfrecords_path)
+
+    if tiling and rm_originals and not animate and not tile_cog:
+        # The originals would be deleted anyway, so the dates not already on disk are tiled straight from the source
+        downloaded_dates, missing_dates = split_downloaded(originals_path, dates, name, originals_format)
+        if len(downloaded_dates):
+            tile_originals(tile_res_path, originals_path, tile, logging, region, res, img_format, originals_format)
+        if len(missing_dates):
+            if cog:
+                print("--cog does not apply to the days tiled straight from GIBS, as their original images are never written")
+            stream_tiles(tile_res_path, xml_path, missing_dates, tile, logging, region, name, res, img_format)
+    else:
+        download_originals(xml_path, originals_path, dates, logging, region, name, res, img_format, cog)
 
-    if tiling:
-        tile_originals(tile_res_path, originals_path, tile, logging, region, res, img_format)
+        if tiling and tile_cog:
+            tile_originals_cog(tile_cog_path, originals_path, tile, logging, img_format, originals_format)
+        elif tiling:
+            tile_originals(tile_res_path, originals_path, tile, logging, region, res, img_format, originals_format)
 
     if write_tfrecords:
         tile_to_tfrecords(tile_res_path, tfrecords_res_path, logging, name, img_format)
         
     if animate:
-        generate_video(originals_path, region, dates, video_path, xml_path, name, res, img_format)
+        generate_video(originals_path, region, dates, video_path, xml_path, name, res, img_format, originals_format)
     
     if rm_originals:
         remove_originals(originals_path, logging)
 
     if not keep_xml:
-        if os.path.exists(xml_path):
-            shutil.rmtree(xml_path)
+        shutil.rmtree(xml_path, ignore_errors=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,12 @@
+import io
 import os
-import glob
+import itertools
+import mmap
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
 
 try:
     import tensorflow as tf
@@ -11,6 +18,8 @@ from GIBSDownloader.file_metadata import TileMetadata
 
 # Constants
 MAX_FILE_SIZE = 100_000_000 # 100 MB recommended TFRecord file size
+PREFETCH_DEPTH = 2 # number of files read ahead of the one being written
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 class TFRecordUtils():
     @classmethod
@@ -31,38 +40,114 @@ class TFRecordUtils():
         return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
     @classmethod
-    def image_example(cls, img_path, metadata):
-        image_raw = open(img_path, 'rb').read()
-        image_shape = tf.image.decode_png(image_raw).shape
+    def get_image_size(cls, image_raw):
+        """Returns (width, height), read from the image header without decoding the pixels."""
+        if image_raw[:8] == PNG_SIGNATURE:
+            return int.from_bytes(image_raw[16:20], 'big'), int.from_bytes(image_raw[20:24], 'big')
+        with Image.open(io.BytesIO(image_raw)) as img: # PIL parses only the header until the pixels are loaded
+            return img.size
 
-        #print("Metdata info:", metadata.date, metadata.region.bl_coords.y, metadata.region.bl_coords.x, metadata.region.tr_coords.y, metadata.region.tr_coords.x)
+    @classmethod
+    def read_image(cls, img_path):
+        """Returns the encoded bytes of an image, copied straight from a read-only memory map."""
+        with open(img_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
 
+    @classmethod
+    def example_template(cls):
+        """Returns an Example holding every feature, meant to be filled in by image_example."""
         feature = {
-            'date': TFRecordUtils._bytes_feature(bytes(metadata.date, 'utf-8')),
-            'image_raw': TFRecordUtils._bytes_feature(image_raw),
-            'width': TFRecordUtils._int64_feature(image_shape[0]),
-            'height': TFRecordUtils._int64_feature(image_shape[1]),
-            'bottom_left_lat': TFRecordUtils._float_feature(metadata.region.bl_coords.y),
-            'bottom_left_long': TFRecordUtils._float_feature(metadata.region.bl_coords.x),
-            'top_right_lat': TFRecordUtils._float_feature(metadata.region.tr_coords.y),
-            'top_right_long': TFRecordUtils._float_feature(metadata.region.tr_coords.x),
+            'date': TFRecordUtils._bytes_feature(b''),
+            'image_raw': TFRecordUtils._bytes_feature(b''),
+            'width': TFRecordUtils._int64_feature(0),
+            'height': TFRecordUtils._int64_feature(0),
+            'bottom_left_lat': TFRecordUtils._float_feature(0.0),
+            'bottom_left_long': TFRecordUtils._float_feature(0.0),
+            'top_right_lat': TFRecordUtils._float_feature(0.0),
+            'top_right_long': TFRecordUtils._float_feature(0.0),
         }
 
         return tf.train.Example(features=tf.train.Features(feature=feature))
-    
+
+    @classmethod
+    def image_example(cls, img_path, metadata, example=None, image_raw=None):
+        if image_raw is None:
+            image_raw = TFRecordUtils.read_image(img_path)
+        width, height = TFRecordUtils.get_image_size(image_raw)
+
+        # Overwrite the values of a reused Example in place rather than allocating new features
+        if example is None:
+            example = TFRecordUtils.example_template()
+        feature = example.features.feature
+        feature['date'].bytes_list.value[:] = [bytes(metadata.date, 'utf-8')]
+        feature['image_raw'].bytes_list.value[:] = [image_raw]
+        feature['width'].int64_list.value[:] = [width]
+        feature['height'].int64_list.value[:] = [height]
+        feature['bottom_left_lat'].float_list.value[:] = [metadata.region.bl_coords.y]
+        feature['bottom_left_long'].float_list.value[:] = [metadata.region.bl_coords.x]
+        feature['top_right_lat'].float_list.value[:] = [metadata.region.tr_coords.y]
+        feature['top_right_long'].float_list.value[:] = [metadata.region.tr_coords.x]
+
+        return example
+
+    @classmethod
+    def iter_files(cls, root, ext):
+        """Yields (path, size) for every file under root ending with ext."""
+        directories = [root]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif entry.name.endswith(ext):
+                        yield entry.path, entry.stat().st_size
+
+    @classmethod
+    def split_into_shards(cls, files):
+        # Group the files so that each TFRecord is closed once it reaches MAX_FILE_SIZE
+        shard_files = []
+        total_file_size = 0
+        for path, size in files:
+            shard_files.append(path)
+            total_file_size += size
+            if total_file_size >= MAX_FILE_SIZE:
+                yield shard_files
+                shard_files = []
+                total_file_size = 0
+        if shard_files:
+            yield shard_files
+
     @classmethod
     def write_to_tfrecords(cls, input_path, output_path, name, img_format):
-        files = [f for f in glob.glob(input_path + "**/*.{}".format(img_format), recursive=True)]
-        count = 0
-        version = 0
-        while(count < len(files)):
-            total_file_size = 0
-            with tf.io.TFRecordWriter("{path}{name}_tf-{v}.tfrecord".format(path=output_path, name=name, v='%.3d' % (version))) as writer:
-                while(total_file_size < MAX_FILE_SIZE and count < len(files)):    
-                    filename = files[count]
-                    metadata = TileMetadata(filename)
-                    total_file_size += os.path.getsize(filename)
-                    tf_example = TFRecordUtils.image_example(filename, metadata)
-                    writer.write(tf_example.SerializeToString())
-                    count += 1
-            version += 1
\ No newline at end of file
+        files = TFRecordUtils.iter_files(input_path, ".{}".format(img_format))
+        shards = (("{path}{name}_tf-{v}.tfrecord".format(path=output_path, name=name, v='%.3d' % (version)), shard_files) for version, shard_files in enumerate(TFRecordUtils.split_into_shards(files)))
+
+        # A Pool starts all its workers at once, each importing TensorFlow, so it gets no more workers than there are shards.
+        # Only the first shards are formed before it starts, the rest are handed over as the walk goes on
+        first_shards = list(itertools.islice(shards, os.cpu_count()))
+        if not first_shards:
+            return
+
+        # Workers are spawned so that no TensorFlow state is inherited, through a Pool as ProcessPoolExecutor only takes a context from Python 3.7
+        with multiprocessing.get_context("spawn").Pool(len(first_shards)) as pool:
+            for _ in pool.imap_unordered(_write_shard, itertools.chain(first_shards, shards)):
+                pass
+
+def _write_shard(shard):
+    shard_path, files = shard
+    tf_example = TFRecordUtils.example_template() # reused for every image in the shard
+
+    # Upcoming files are read in the background while the current one is serialized and written
+    with ThreadPoolExecutor(max_workers=PREFETCH_DEPTH) as reader, tf.io.TFRecordWriter(shard_path) as writer:
+        pending = deque(reader.submit(TFRecordUtils.read_image, path) for path in files[:PREFETCH_DEPTH])
+        for index, path in enumerate(files):
+            image_raw = pending.popleft().result()
+            if index + PREFETCH_DEPTH < len(files):
+                pending.append(reader.submit(TFRecordUtils.read_image, files[index + PREFETCH_DEPTH]))
+
+            metadata = TileMetadata(path) # parses the date and region from the filename once
+            TFRecordUtils.image_example(path, metadata, tf_example, image_raw=image_raw)
+            writer.write(tf_example.SerializeToString())
@@ -1,48 +1,138 @@
 import os
-from datetime import date, timedelta
+import functools
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from osgeo import gdal
 
 from GIBSDownloader.product import Product
 from GIBSDownloader.coordinate_utils import Rectangle, Coordinate
 
+# Settings for fetching and translating GIBS tiles, applied unless the user already set them in the environment
+GDAL_CONFIG = {
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'GDAL_HTTP_VERSION': '2',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_MAX_RETRY': '3',
+    'GDAL_HTTP_RETRY_DELAY': '1',
+    'GDAL_HTTP_CONNECTTIMEOUT': '10',
+    'GDAL_HTTP_TIMEOUT': '60',
+    'GDAL_DEFAULT_WMS_CACHE_PATH': os.path.join(os.path.expanduser('~'), '.cache', 'GIBSDownloader'), # WMS tiles kept across runs
+}
+
+MAX_DOWNLOAD_WORKERS = 8 # number of dates downloaded concurrently
+MAX_WMS_CONNECTIONS = 8 # parallel tile requests per date, GDAL's WMS driver defaults to 2
+COG_CREATION_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=2', 'BLOCKSIZE=512', 'OVERVIEW_RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+XML_TEMPLATE = '<GDAL_WMS><Service name="TiledWMS"><ServerUrl>https://gibs.earthdata.nasa.gov/twms/epsg4326/best/twms.cgi?</ServerUrl><TiledGroupName>{name} tileset</TiledGroupName><Change key="${{time}}"></Change></Service><MaxConnections>{max_connections}</MaxConnections><Cache/></GDAL_WMS>'
+
+@functools.lru_cache(maxsize=None)
+def _render_xml(name):
+    # Only the text is memoized, the file itself may have been removed since (e.g. by an earlier run without --keep-xml)
+    return XML_TEMPLATE.format(name=name, max_connections=MAX_WMS_CONNECTIONS)
+
 class TiffDownloader():
 
+    @classmethod
+    def configure_gdal(cls):
+        # Changes process wide GDAL state, so it is left to the command line tool and download_range rather than done on import
+        gdal.UseExceptions()
+        for key, value in GDAL_CONFIG.items():
+            if gdal.GetConfigOption(key) is None:
+                gdal.SetConfigOption(key, value)
+
     @classmethod
     def generate_download_filename(cls, output, name, date):
-        return "{}{}_{}".format(output, name, date)
+        return f"{output}{name}_{date}"
+
+    @classmethod
+    def is_downloaded(cls, path):
+        # Downloads are only renamed into place once complete, so any non-empty file is a finished one
+        try:
+            return os.path.getsize(path) > 0
+        except OSError:
+            return False
 
     @classmethod
-    def download_area_tiff(cls, region, date, xml_path, filename, name, res, img_format, width=None, height=None):
-        
+    def translate_options(cls, region, res, img_format, width=None, height=None, cog=False):
         if width == None and height == None:
             width, height = region.calculate_width_height(res)
-        lon_lat = "{l_x} {upper_y} {r_x} {lower_y}".format(l_x=region.bl_coords.x, upper_y=region.tr_coords.y, r_x=region.tr_coords.x, lower_y=region.bl_coords.y)
-        
-        xml_filename = TiffDownloader.generate_xml(xml_path, name, date)
-        command = "gdal_translate -of {of} -outsize {w} {h} -projwin {ll} {xml} {f}.{ext}".format(of=img_format.upper(), w=width, h=height, ll=lon_lat, xml=xml_filename, f=filename, ext=img_format)
-        os.system(command)
+        projwin = [region.bl_coords.x, region.tr_coords.y, region.tr_coords.x, region.bl_coords.y]
+
+        if cog:
+            # Tiled, compressed and with overviews, the georeferencing is stored in the file itself
+            return gdal.TranslateOptions(format='COG', width=width, height=height, projWin=projwin, creationOptions=COG_CREATION_OPTIONS)
+        return gdal.TranslateOptions(format=img_format.upper(), width=width, height=height, projWin=projwin)
 
     @classmethod
-    def get_dates_range(cls, start_date, end_date):
-        start_components = start_date.split('-')
-        end_components = end_date.split('-')
+    def download_area_tiff(cls, region, date, xml_path, filename, name, res, img_format, width=None, height=None, cog=False, options=None, force=False):
+        output_filename = f"{filename}.{'tif' if cog else img_format}"
+        if not force and TiffDownloader.is_downloaded(output_filename):
+            return output_filename
+        if options is None:
+            options = TiffDownloader.translate_options(region, res, img_format, width, height, cog)
 
-        d1 = date(int(start_components[0]), int(start_components[1]), int(start_components[2]))
-        d2 = date(int(end_components[0]), int(end_components[1]), int(end_components[2]))
+        src = TiffDownloader.open_source(TiffDownloader.generate_xml(xml_path, name), date)
+        # Translate in-process rather than launching gdal_translate for every date.
+        # The image is written under a temporary name, so an interrupted translate never looks downloaded
+        tmp_filename = output_filename + '.tmp'
+        ds = gdal.Translate(tmp_filename, src, options=options)
+        ds = None # closing the dataset flushes the image and its .aux.xml georeferencing to disk
+        if os.path.isfile(tmp_filename + '.aux.xml'):
+            os.replace(tmp_filename + '.aux.xml', output_filename + '.aux.xml')
+        os.replace(tmp_filename, output_filename)
+        return output_filename
 
-        dates = [d1 + timedelta(days=x) for x in range((d2 - d1).days + 1)]
-        return dates
-    
     @classmethod
-    def generate_xml(cls, xml_path, name, date):
-        xml_base = '<GDAL_WMS><Service name="TiledWMS"><ServerUrl>https://gibs.earthdata.nasa.gov/twms/epsg4326/best/twms.cgi?'
-        xml_end = '</ServerUrl><TiledGroupName>{name} tileset</TiledGroupName><Change key="${{time}}">{date}</Change></Service></GDAL_WMS>'.format(name=name,date=date)
-        xml_content = xml_base + xml_end
+    def download_range(cls, region, dates, xml_path, output, name, res, img_format, logging=False, cog=False, max_workers=MAX_DOWNLOAD_WORKERS):
+        TiffDownloader.configure_gdal()
+        extension = 'tif' if cog else img_format
+        options = TiffDownloader.translate_options(region, res, img_format, cog=cog) # same for every date, so built once
+        date_strs = np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]'), unit='D') # all YYYY-MM-DD strings in one call
 
-        xml_filename = '{}{}.xml'.format(xml_path, date)
+        def download(date):
+            filename = TiffDownloader.generate_download_filename(output, name.replace(" ","-"), date)
+            if not TiffDownloader.is_downloaded(f"{filename}.{extension}"):
+                if logging:
+                    print('Downloading:', date)
+                TiffDownloader.download_area_tiff(region, date, xml_path, filename, name, res, img_format, cog=cog, options=options)
 
-        with open(xml_filename, 'w') as xml_file:
-            xml_file.write(xml_content)
-        return xml_filename
+        # Each date is an independent request to GIBS, so download several at once
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(dates)))) as executor:
+            futures = [executor.submit(download, date) for date in date_strs]
+            for count, future in enumerate(as_completed(futures)):
+                future.result()
+                if logging:
+                    print("Finished {} of {} dates".format(count + 1, len(dates)))
 
+    @classmethod
+    def get_dates_range(cls, start_date, end_date):
+        # Consecutive days as a single datetime64 array rather than a list of date objects.
+        # strptime also accepts dates without zero padding (e.g. 2020-9-1), which datetime64 rejects
+        start = np.datetime64(datetime.strptime(start_date, "%Y-%m-%d").date(), 'D')
+        end = np.datetime64(datetime.strptime(end_date, "%Y-%m-%d").date(), 'D')
+        dates = np.arange(start, end + np.timedelta64(1, 'D'))
+        return dates
+    
+    @classmethod
+    def generate_xml(cls, xml_path, name):
+        # One config per product, the date is supplied when the source is opened (see open_source)
+        xml_filename = f'{xml_path}{name.replace(" ", "-")}.xml'
+        xml_text = _render_xml(name)
+        if os.path.isfile(xml_filename):
+            # A config left by an older version of the template is rewritten
+            with open(xml_filename) as xml_file:
+                if xml_file.read() == xml_text:
+                    return xml_filename
 
+        # Written under a temporary name and renamed, as several downloads (threads or processes) may ask for the config at once
+        tmp_filename = f'{xml_filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_filename, 'w') as xml_file:
+            xml_file.write(xml_text)
+        os.replace(tmp_filename, xml_filename)
+        return xml_filename
 
+    @classmethod
+    def open_source(cls, xml_filename, date):
+        return gdal.OpenEx(xml_filename, gdal.OF_RASTER, open_options=[f'Change=time:{date}'])
@@ -1,7 +1,10 @@
+from typing import NamedTuple
+
+from GIBSDownloader.handling import Handling
+
 # Stores tiling information
-class Tile():
-    def __init__(self, width, height, overlap, handling):
-        self.width = width
-        self.height = height
-        self.overlap = overlap
-        self.handling = handling
\ No newline at end of file
+class Tile(NamedTuple):
+    width: int
+    height: int
+    overlap: float
+    handling: Handling
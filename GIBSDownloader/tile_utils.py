@@ -1,84 +1,140 @@
 import argparse
+import functools
 import os
 import math
 import warnings
 import shutil
+import threading
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing.pool import ThreadPool as Pool
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8, tiles are then generated in a single process
+    shared_memory = None
 
 import numpy as np
 from matplotlib import pyplot as plt
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 from PIL import Image
 from tqdm import tqdm 
-from bs4 import BeautifulSoup as bs
+try:
+    import simplejpeg
+except ImportError: # optional, PIL is used to encode the tiles instead
+    simplejpeg = None
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError): # optional, also needs the libturbojpeg library to be found
+    turbo_jpeg = None
+try:
+    import tifffile
+except ImportError: # optional, the intermediate images are then decoded with PIL
+    tifffile = None
+try:
+    import psutil
+except ImportError: # optional, the free memory is then read with os.sysconf where available
+    psutil = None
 
 from GIBSDownloader.tile import Tile
 from GIBSDownloader.handling import Handling
 from GIBSDownloader.file_metadata import TiffMetadata, IntermediateMetadata
 from GIBSDownloader.coordinate_utils import Coordinate, Rectangle
+from GIBSDownloader.tiff_downloader import TiffDownloader
 
 warnings.simplefilter('ignore', Image.DecompressionBombWarning)
 
 MAX_INTERMEDIATE_LENGTH = int(math.sqrt(2 * Image.MAX_IMAGE_PIXELS)) # Maximum width and height for an intermediate tile to guarantee num pixels less than PIL's max
 
+INTERMEDIATE_FORMAT = 'tif' # uncompressed, so the intermediate images can be memory mapped instead of decoded
+INTERMEDIATE_CACHE_SIZE = 4 # minimum decoded intermediate images kept in memory, enough for one group of four
+JPEG_QUALITY = 75 # matches PIL's default, so tiles look the same with either encoder
+
+# Copies src into dst with its top left corner at (y0, x0), a single slice assignment (i.e. a memcpy per row)
+def _paste(dst, src, y0=0, x0=0):
+    dst[y0:y0 + src.shape[0], x0:x0 + src.shape[1]] = src
+
+# Canvas for padded and stitched tiles, reused by every tile written from the same thread
+_scratch = threading.local()
+
+def _tile_canvas(shape, dtype):
+    canvas = getattr(_scratch, 'canvas', None)
+    if canvas is None or canvas.shape != shape or canvas.dtype != dtype:
+        canvas = _scratch.canvas = np.empty(shape, dtype=dtype)
+    return canvas
+
+# Every process cutting intermediates opens the original once, rather than once per intermediate.
+# GDAL datasets cannot be shared between threads or processes, so each process keeps its own
+@functools.lru_cache(maxsize=1)
+def _open_original(tiff_path):
+    return gdal.Open(tiff_path)
+
+# Per-process state for the tiling workers, set once by _init_tile_worker
+_worker = {}
+
+def _init_tile_worker(shm_name, shape, dtype, tile, WIDTH, HEIGHT, img_format):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker.update(shm=shm, img_arr=np.ndarray(shape, dtype=dtype, buffer=shm.buf), tile=tile, WIDTH=WIDTH, HEIGHT=HEIGHT, img_format=img_format)
+
+def _write_tiles_worker(batch):
+    for tile_path, x, y, done_x, done_y in batch:
+        TileUtils.generate_tile(_worker['tile'], _worker['img_arr'], tile_path, _worker['WIDTH'], _worker['HEIGHT'], x, y, done_x, done_y, _worker['img_format'])
+    return len(batch)
+
 class TileUtils():
     @classmethod
-    def getGeoTransform(cls, path):
-        content = []
-        # Read the XML file
-        with open(path, "r") as f:
-            # Read each line in the file, readlines() returns a list of lines
-            content = f.readlines()
-            # Combine the lines in the list into a string
-            content = "".join(content)
-            bs_content = bs(content, "lxml")
-            values = str(bs_content.find("geotransform")).replace("<geotransform> ", "").replace("</geotransform>","").split(",")
-        return float(values[0]),float(values[1]),float(values[3]),float(values[5])
+    def getGeoTransform(cls, ds):
+        # GDAL reads the georeferencing from the image itself or from its .aux.xml sidecar
+        x_min, x_size, _, y_min, _, y_size = ds.GetGeoTransform()
+        return x_min, x_size, y_min, y_size
+
+    @classmethod
+    def read_pixels(cls, ds, x=0, y=0, width=None, height=None):
+        # The tile writers expect the bands last, so GDAL writes through a bands-first view of a bands-last array rather than into a copy to transpose
+        width = ds.RasterXSize if width is None else width
+        height = ds.RasterYSize if height is None else height
+        if ds.RasterCount == 1:
+            return ds.ReadAsArray(x, y, width, height)
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+        img_arr = np.empty((height, width, ds.RasterCount), dtype=dtype)
+        ds.ReadAsArray(x, y, width, height, buf_obj=img_arr.transpose(2, 0, 1))
+        return img_arr
         
+    @classmethod
+    def compute_starts(cls, length, tile_length, step, handling):
+        # Start positions of every tile that fits entirely within the image
+        starts = np.arange(0, length - tile_length + 1, step)
+        done = np.zeros(len(starts), dtype=bool)
+
+        # The next step would run past the boundary, the handling decides what to do with that tile
+        boundary = starts[-1] + step
+        if boundary < length:
+            if handling == Handling.complete_tiles_shift and starts[-1] != length - tile_length:
+                starts = np.append(starts, length - tile_length)
+                done = np.append(done, True)
+            elif handling == Handling.include_incomplete_tiles:
+                starts = np.append(starts, boundary)
+                done = np.append(done, True)
+        return starts, done
+
     @classmethod
     def getTilingSplitCoords(cls, tile, WIDTH, HEIGHT):
         x_step, y_step = int(tile.width * (1 - tile.overlap)), int(tile.height * (1 - tile.overlap))
-        x = 0 
-        done_x = False
 
         # Check for valid tiling
         if (tile.width > WIDTH or tile.height > HEIGHT):
             raise argparse.ArgumentTypeError("Tiling dimensions greater than image dimensions")
 
-        # Calculate the number of tiles to be generated
-        if tile.handling == Handling.discard_incomplete_tiles:
-            num_iterations = (WIDTH - tile.width * tile.overlap) // (tile.width * (1 - tile.overlap)) * (HEIGHT - tile.height * tile.overlap) // (tile.height * (1 -  tile.overlap))
-        else:
-            num_iterations = math.ceil((WIDTH - tile.width * tile.overlap) / (tile.width * (1 - tile.overlap))) * math.ceil((HEIGHT - tile.height * tile.overlap) / (tile.height * (1 -  tile.overlap)))
-        
-        pixel_coords = []
-
-        while(x < WIDTH and not done_x):
-            if(WIDTH - x < tile.width):
-                done_x = True
-                if tile.handling == Handling.discard_incomplete_tiles:
-                    continue
-                if tile.handling == Handling.complete_tiles_shift:
-                    x = WIDTH - tile.width
-            done_y = False
-            y = 0
-            while (y < HEIGHT and not done_y):
-                if(HEIGHT - y < tile.height):
-                    done_y = True
-                    if tile.handling == Handling.discard_incomplete_tiles:
-                        continue
-                    if tile.handling == Handling.complete_tiles_shift:
-                        y = HEIGHT - tile.height 
-                    
-                pixel_coords.append((x, y, done_x, done_y))
-
-                y += y_step
-            x += x_step
-        return pixel_coords
+        xs, done_xs = TileUtils.compute_starts(WIDTH, tile.width, x_step, tile.handling)
+        ys, done_ys = TileUtils.compute_starts(HEIGHT, tile.height, y_step, tile.handling)
+
+        # Broadcast the starts into the full grid, column by column, i.e. x in the outer loop and y in the inner one
+        x_grid, y_grid = np.meshgrid(xs, ys, indexing='ij')
+        done_x_grid, done_y_grid = np.meshgrid(done_xs, done_ys, indexing='ij')
+        return list(zip(x_grid.ravel().tolist(), y_grid.ravel().tolist(), done_x_grid.ravel().tolist(), done_y_grid.ravel().tolist()))
 
     @classmethod
-    def img_to_tiles(cls, tiff_path, region, res, tile, tile_date_path, img_format):
+    def img_to_tiles(cls, tiff_path, region, res, tile, tile_date_path, img_format, mp=True, num_processes=1):
         # Get metadata from original image
         metadata = TiffMetadata(tiff_path)
 
@@ -88,182 +144,240 @@ class TileUtils():
             ultra_large = True
 
         # Use the following to get the coordinates of each tile
-        x_min, x_size, y_min, y_size = TileUtils.getGeoTransform(tiff_path + ".aux.xml")
+        src_ds = gdal.Open(tiff_path)
+        x_min, x_size, y_min, y_size = TileUtils.getGeoTransform(src_ds)
        
         # Find the pixel coordinate extents of each tile to be generated
         pixel_coords = TileUtils.getTilingSplitCoords(tile, WIDTH, HEIGHT)
+        tile_names = TileUtils.generate_tile_names_with_coordinates(metadata.date, pixel_coords, x_min, x_size, y_min, y_size, tile)
+        tile_paths = TileUtils.generate_tile_paths(tile_date_path, tile_names, img_format)
 
         if ultra_large: 
             # Create the intermediate tiles
-            inter_dir, img_width, img_height = TileUtils.img_to_intermediate_images(tiff_path, tile, WIDTH, HEIGHT, metadata.date, img_format)
+            inter_dir, img_width, img_height = TileUtils.img_to_intermediate_images(tiff_path, tile, WIDTH, HEIGHT, metadata.date, INTERMEDIATE_FORMAT, mp=mp)
 
             # Add each coordinate to its proper list
-            intermediate_files = [f for f in os.listdir(inter_dir) if f.endswith(img_format)]
+            intermediate_files = [f for f in os.listdir(inter_dir) if f.endswith(INTERMEDIATE_FORMAT)]
             intermediate_files.sort()
+            inter_meta = {filename: IntermediateMetadata(filename) for filename in intermediate_files} # parsed once per image
 
-            single_inter_pixel_coords = [] # for the tiles that fit in a single image
-            double_inter_pixel_coords = [] # for the tiles which require two images
-            quad_inter_pixel_coords = [] # for the tiles which require four images
-
-            # Get tiling information for single images
-            for filename in intermediate_files:
-                inter_metadata = IntermediateMetadata(filename)
-                inter_coords = [(inter_metadata.name, x,y, done_x, done_y) for (x,y, done_x, done_y) in pixel_coords if x >= inter_metadata.start_x and y >= inter_metadata.start_y and x + tile.width <= inter_metadata.end_x and y + tile.height <= inter_metadata.end_y]
-                if inter_coords:
-                    single_inter_pixel_coords.append(inter_coords)
-            
-            # Get tiling information for between two images
-            for index, filename in enumerate(intermediate_files):
-                inter_metadata = IntermediateMetadata(filename)
-                double_coords_raw = [(x,y, done_x, done_y) for (x,y,done_x,done_y) in pixel_coords if (x < inter_metadata.end_x and x + tile.width > inter_metadata.end_x and y >= inter_metadata.start_y and y + tile.height <= inter_metadata.end_y) or (y < inter_metadata.end_y and y + tile.height > inter_metadata.end_y and x >= inter_metadata.start_x and x + tile.width <= inter_metadata.end_x)]
-
-                if double_coords_raw:
-                    double_coords_LR = [(filename, intermediate_files[index + math.ceil(HEIGHT / img_height)], x, y, done_x, done_y) for (x, y, done_x, done_y) in double_coords_raw if x < inter_metadata.end_x and x + tile.width > inter_metadata.end_x]
-                    double_coords_AB = [(filename, intermediate_files[index + 1], x, y, done_x, done_y) for (x, y, done_x, done_y) in double_coords_raw if y < inter_metadata.end_y and y + tile.height > inter_metadata.end_y]
-                    if double_coords_LR:
-                        double_inter_pixel_coords.append(double_coords_LR)
-                    if double_coords_AB:
-                        double_inter_pixel_coords.append(double_coords_AB)
-
-            # Get tiling information for between four images
-            for index, filename in enumerate(intermediate_files):
-                inter_metadata = IntermediateMetadata(filename)
-                quad_coords = [(filename, intermediate_files[index+1], intermediate_files[index + math.ceil(HEIGHT / img_height)], intermediate_files[index + math.ceil(HEIGHT / img_height) + 1], x, y, done_x, done_y) for (x,y,done_x,done_y) in pixel_coords if ((not done_x) and (not done_y) and x < inter_metadata.end_x and x + tile.width > inter_metadata.end_x and y < inter_metadata.end_y and y + tile.height > inter_metadata.end_y)]
-                if quad_coords:
-                    quad_inter_pixel_coords.append(quad_coords)
+            # Sort the tiles into those that fit in a single image, and those that require two or four images
+            inter_groups = TileUtils.group_intermediate_coords(pixel_coords, tile, intermediate_files, WIDTH, HEIGHT, img_width, img_height)
         
             print("Tiling intermediate images...")
 
-            # Tile the complete images
-            for single_inter_imgs in tqdm(single_inter_pixel_coords):
-                filename = single_inter_imgs[0][0]
-                inter_metadata = IntermediateMetadata(filename)
-
-                img_path = os.path.join(inter_dir, filename)
-                src = Image.open(img_path)
-                img_arr = np.array(src)
-
-                for i, (filename, x, y, done_x, done_y) in enumerate(single_inter_imgs):
-                    TileUtils.generate_tile(tile, img_arr, tile_date_path, metadata, inter_metadata.end_x - inter_metadata.start_x, inter_metadata.end_y - inter_metadata.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y, img_format, inter_x=(x - inter_metadata.start_x), inter_y=(y - inter_metadata.start_y))
-
-                """
-                #Use multithreading to tile the numpy array
-                num_cores = multiprocessing.cpu_count()
-                print("Generating {} tiles using {} threads...".format(len(single_inter_imgs), num_cores), end="")
-                pool = Pool(num_cores)
-
-                for i, (filename, x, y, done_x, done_y) in enumerate(single_inter_imgs):
-                    pool.apply_async(TileUtils.generate_tile, args=(tile, img_arr, tile_date_path, metadata, inter_metadata.end_x - inter_metadata.start_x, inter_metadata.end_y - inter_metadata.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y,), kwds={"inter_x":(x - inter_metadata.start_x), "inter_y":(y - inter_metadata.start_y)})
-                pool.close()
-                pool.join()
-                """
-            
-            # Tile in between two images
-            for double_inter_imgs in tqdm(double_inter_pixel_coords):
-                filename_left = double_inter_imgs[0][0]
-                filename_right = double_inter_imgs[0][1]
-
-                inter_metadata_left = IntermediateMetadata(filename_left)
-                inter_metadata_right = IntermediateMetadata(filename_right)
-
-                img_path_left = os.path.join(inter_dir, filename_left)
-                img_path_right = os.path.join(inter_dir, filename_right)
-
-                src_left = Image.open(img_path_left)
-                img_arr_left = np.array(src_left)
-
-                src_right = Image.open(img_path_right)
-                img_arr_right = np.array(src_right)
-
-                for i, (f1, f2, x, y, done_x, done_y) in enumerate(double_inter_imgs):
-                    TileUtils.generate_tile_between_two_images(tile, img_arr_left, img_arr_right, tile_date_path, metadata, inter_metadata_left.end_x - inter_metadata_left.start_x, inter_metadata_left.end_y - inter_metadata_left.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y, x - inter_metadata_left.start_x, y - inter_metadata_left.start_y, img_format)
-
-                
-                #Use multithreading to tile the numpy array
-                """
-                num_cores = multiprocessing.cpu_count()
-                print("Generating {} tiles using {} threads...".format(len(double_inter_imgs), num_cores), end="")
-                pool = Pool(num_cores)
-                for i, (f1, f2, x, y, done_x, done_y) in enumerate(double_inter_imgs):
-                    pool.apply_async(TileUtils.generate_tile_between_two_images, args=(tile, img_arr_left, img_arr_right, tile_date_path, metadata, inter_metadata_left.end_x - inter_metadata_left.start_x, inter_metadata_left.end_y - inter_metadata_left.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y, x - inter_metadata_left.start_x, y - inter_metadata_left.start_y))
-                pool.close()
-                pool.join()
-                """
-            
-            # Tile in between four images  
-            for quad_inter_imgs in tqdm(quad_inter_pixel_coords):
-                filename_TL = quad_inter_imgs[0][0]
-                filename_BL = quad_inter_imgs[0][1]
-                filename_TR = quad_inter_imgs[0][2]
-                filename_BR = quad_inter_imgs[0][3]       
-
-                inter_metadata_TL = IntermediateMetadata(filename_TL)
-                inter_metadata_TR = IntermediateMetadata(filename_TR)
-                inter_metadata_BL = IntermediateMetadata(filename_BL)
-                inter_metadata_BR = IntermediateMetadata(filename_BR)
-
-                img_path_TL = os.path.join(inter_dir, filename_TL)
-                img_path_TR = os.path.join(inter_dir, filename_TR)
-                img_path_BL = os.path.join(inter_dir, filename_BL)
-                img_path_BR = os.path.join(inter_dir, filename_BR)
-
-                src_TL = Image.open(img_path_TL)
-                img_arr_TL = np.array(src_TL)
-
-                src_TR = Image.open(img_path_TR)
-                img_arr_TR = np.array(src_TR)
-
-                src_BL = Image.open(img_path_BL)
-                img_arr_BL = np.array(src_BL)
-                
-                src_BR = Image.open(img_path_BR)
-                img_arr_BR = np.array(src_BR)
-
-                for i, (f1, f2, f3, f4, x, y, done_x, done_y) in enumerate(quad_inter_imgs):
-                    TileUtils.generate_tile_between_four_images(tile, img_arr_TL, img_arr_TR, img_arr_BL, img_arr_BR, tile_date_path, metadata, inter_metadata_TL.end_x - inter_metadata_TL.start_x, inter_metadata_TL.end_y - inter_metadata_TL.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y, x - inter_metadata_TL.start_x, y - inter_metadata_TL.start_y, img_format)
-               
-                #Use multithreading to tile the numpy array
-                """
-                num_cores = multiprocessing.cpu_count()
-                print("Generating {} tiles using {} threads...".format(len(quad_inter_imgs), num_cores), end="")
-                pool = Pool(num_cores)
-
-                for i, (f1, f2, f3, f4, x, y, done_x, done_y) in enumerate(quad_inter_imgs):
-                    pool.apply_async(TileUtils.generate_tile_between_four_images, args=(tile, img_arr_TL, img_arr_TR, img_arr_BL, img_arr_BR, tile_date_path, metadata, inter_metadata.end_x - inter_metadata.start_x, inter_metadata.end_y - inter_metadata.start_y, x_min, x_size, y_min, y_size, x, y, done_x, done_y, x - inter_metadata.start_x, y - inter_metadata.start_y))
-                pool.close()
-                pool.join()
-                """
+            # Groups come image by image, so the cache lets neighbouring groups share decoded images
+            @functools.lru_cache(maxsize=TileUtils.intermediate_cache_size(HEIGHT, img_width, img_height, num_processes))
+            def load_intermediate(filename):
+                return TileUtils.read_intermediate(os.path.join(inter_dir, filename))
+
+            def write_tile(num_images, img_arrs, inter_metadata, tile_info):
+                inter_width, inter_height = inter_metadata.end_x - inter_metadata.start_x, inter_metadata.end_y - inter_metadata.start_y
+                x, y, done_x, done_y = tile_info[num_images:]
+                inter_x, inter_y = x - inter_metadata.start_x, y - inter_metadata.start_y
+                if num_images == 1: # Tile the complete images
+                    TileUtils.generate_tile(tile, img_arrs[0], tile_paths[(x, y)], inter_width, inter_height, x, y, done_x, done_y, img_format, inter_x=inter_x, inter_y=inter_y)
+                elif num_images == 2: # Tile in between two images
+                    TileUtils.generate_tile_between_two_images(tile, img_arrs[0], img_arrs[1], tile_paths[(x, y)], inter_width, inter_height, done_x, done_y, inter_x, inter_y, img_format)
+                else: # Tile in between four images, the group lists them as top left, bottom left, top right, bottom right
+                    img_arr_TL, img_arr_BL, img_arr_TR, img_arr_BR = img_arrs
+                    TileUtils.generate_tile_between_four_images(tile, img_arr_TL, img_arr_TR, img_arr_BL, img_arr_BR, tile_paths[(x, y)], inter_width, inter_height, done_x, done_y, inter_x, inter_y, img_format)
+
+            # A single thread pool, kept for every group, writes the tiles while the decoded images are shared in memory
+            pool = Pool(os.cpu_count()) if mp else None
+            try:
+                for num_images, inter_imgs in tqdm(inter_groups):
+                    filenames = inter_imgs[0][:num_images]
+                    inter_metadata = inter_meta[filenames[0]] # the image holding the top left corner of the tiles
+                    img_arrs = [load_intermediate(filename) for filename in filenames]
+                    write_group_tile = functools.partial(write_tile, num_images, img_arrs, inter_metadata)
+                    if pool is not None:
+                        pool.map(write_group_tile, inter_imgs, chunksize=max(1, len(inter_imgs) // (os.cpu_count() * 4)))
+                    else:
+                        for tile_info in inter_imgs:
+                            write_group_tile(tile_info)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            load_intermediate.cache_clear()
             print("Finished tiling all the intermediates")
             shutil.rmtree(inter_dir)
         else: 
-            # Open GeoTiff as numpy array in order to tile from the array
-            src = Image.open(tiff_path)
-            img_arr = np.array(src)
-
-            for i, (x, y, done_x, done_y) in enumerate(pixel_coords):
-                TileUtils.generate_tile(tile, img_arr, tile_date_path, metadata, WIDTH, HEIGHT, x_min, x_size, y_min, y_size, x, y, done_x, done_y, img_format)
-
-            #Use multithreading to tile the numpy array
-            """
-            num_cores = multiprocessing.cpu_count()
-            print("Generating {} tiles using {} threads...".format(len(pixel_coords), num_cores), end="")
-            pool = Pool(1)
-            for i, (x, y, done_x, done_y) in enumerate(pixel_coords):
-                pool.apply_async(TileUtils.generate_tile, args=(tile, img_arr, tile_date_path, metadata, WIDTH, HEIGHT, x_min, x_size, y_min, y_size, x, y, done_x, done_y))
-            
-            pool.close()
-            pool.join()
-            """
+            if mp and (TileUtils.encodes_without_gil(img_format) or shared_memory is not None):
+                # Read the pixels through the dataset already open for the georeferencing, without a PIL copy of the image
+                img_arr = TileUtils.read_pixels(src_ds)
+                if TileUtils.encodes_without_gil(img_format):
+                    TileUtils.generate_tiles_threaded(tile, img_arr, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format)
+                else:
+                    TileUtils.generate_tiles_mp(tile, img_arr, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format)
+            elif src_ds.GetDriver().ShortName == 'GTiff':
+                # GeoTiffs (e.g. the --cog originals) read any window cheaply, so each worker process only holds a tile at a time
+                TileUtils.generate_tiles_windowed(tile, src_ds, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format)
+            else:
+                src = Image.open(tiff_path)
+                src.load()
+                TileUtils.generate_tiles_cropped(tile, src, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format)
             print("done!")
 
     @classmethod
-    def generate_tile(cls, tile, img_arr, tile_date_path, metadata, WIDTH, HEIGHT, x_min, x_size, y_min, y_size, x, y, done_x, done_y, img_format, inter_x = None, inter_y = None):
-        # Find which MODIS grid location the current tile fits into
-        output_filename, region = TileUtils.generate_tile_name_with_coordinates(metadata.date, x, x_min, x_size, y, y_min, y_size, tile)
-        output_path = tile_date_path + region.lat_lon_to_modis() + '/'
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
+    def generate_tiles_mp(cls, tile, img_arr, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format):
+        # Place the pixels in shared memory once, so worker processes read them without a copy per process
+        shm = shared_memory.SharedMemory(create=True, size=img_arr.nbytes)
+        try:
+            shared_arr = np.ndarray(img_arr.shape, dtype=img_arr.dtype, buffer=shm.buf)
+            np.copyto(shared_arr, img_arr)
+            del shared_arr
+
+            jobs = [(tile_paths[(x, y)], x, y, done_x, done_y) for (x, y, done_x, done_y) in pixel_coords]
+            initargs = (shm.name, img_arr.shape, img_arr.dtype, tile, WIDTH, HEIGHT, img_format)
+            num_workers = os.cpu_count()
+            with multiprocessing.Pool(num_workers, initializer=_init_tile_worker, initargs=initargs) as pool, tqdm(total=len(jobs)) as pbar:
+                for done in pool.imap_unordered(_write_tiles_worker, TileUtils.batches(jobs, num_workers)):
+                    pbar.update(done)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    @classmethod
+    def img_to_cog(cls, tiff_path, tile, out_path, img_format):
+        # A single internally tiled Cloud Optimized GeoTiff with overviews, in place of one file per tile
+        compression = ['COMPRESS=JPEG', 'QUALITY={}'.format(JPEG_QUALITY)] if img_format in ('jpeg', 'jpg') else ['COMPRESS=DEFLATE', 'PREDICTOR=YES']
+        gdal.Translate(out_path + '.tmp', tiff_path, format='COG', creationOptions=['BLOCKSIZE={}'.format(tile.width), 'NUM_THREADS=ALL_CPUS'] + compression)
+        os.replace(out_path + '.tmp', out_path)
 
+    @classmethod
+    def generate_tiles_cropped(cls, tile, src, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format):
+        # PIL saves the complete tiles straight from the decoded image, only the padded ones need an array
+        img_arr = None
+        for (x, y, done_x, done_y) in pixel_coords:
+            if tile.handling == Handling.include_incomplete_tiles and (done_x or done_y):
+                if img_arr is None:
+                    img_arr = np.asarray(src)
+                TileUtils.generate_tile(tile, img_arr, tile_paths[(x, y)], WIDTH, HEIGHT, x, y, done_x, done_y, img_format)
+            else:
+                src.crop((x, y, x + tile.width, y + tile.height)).save(tile_paths[(x, y)])
+
+    @classmethod
+    def generate_tiles_threaded(cls, tile, img_arr, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format):
+        # The encoder releases the GIL, so threads tile in parallel straight from the array without copying it to other processes
+        def write_tiles(batch):
+            for (x, y, done_x, done_y) in batch:
+                TileUtils.generate_tile(tile, img_arr, tile_paths[(x, y)], WIDTH, HEIGHT, x, y, done_x, done_y, img_format)
+            return len(batch)
+
+        num_workers = os.cpu_count()
+        with Pool(num_workers) as pool, tqdm(total=len(pixel_coords)) as pbar:
+            for done in pool.imap_unordered(write_tiles, TileUtils.batches(pixel_coords, num_workers)):
+                pbar.update(done)
+
+    @classmethod
+    def batches(cls, jobs, num_workers):
+        # Workers take a batch of tiles per round trip and the progress bar moves once per batch rather than once per tile
+        batch_size = max(1, len(jobs) // (num_workers * 8))
+        return [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+
+    @classmethod
+    def available_memory(cls):
+        # Free memory in bytes, or None where it cannot be determined (e.g. Windows without psutil)
+        if psutil is not None:
+            return psutil.virtual_memory().available
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    @classmethod
+    def tiling_processes(cls, WIDTH, HEIGHT, num_images):
+        # Each process holds a decoded image, or the smallest intermediate cache for larger ones, kept to half the free memory (RGB images)
+        num_processes = max(1, min(os.cpu_count(), num_images))
+        available = TileUtils.available_memory()
+        if available is None:
+            return num_processes
+        image_bytes = min(WIDTH * HEIGHT, INTERMEDIATE_CACHE_SIZE * MAX_INTERMEDIATE_LENGTH ** 2) * 3
+        affordable = available // (2 * image_bytes)
+        return max(1, min(num_processes, affordable))
+
+    @classmethod
+    def intermediate_cache_size(cls, HEIGHT, img_width, img_height, num_processes=1):
+        # Two columns of the grid let each intermediate be decoded once, kept to this process's share of half the free memory (RGB images)
+        available = TileUtils.available_memory()
+        if available is None:
+            return INTERMEDIATE_CACHE_SIZE
+        num_rows = -(-HEIGHT // img_height)
+        affordable = available // (2 * num_processes * img_width * img_height * 3)
+        return max(INTERMEDIATE_CACHE_SIZE, min(2 * num_rows + 2, affordable))
+
+    @classmethod
+    def read_intermediate(cls, path):
+        # Memory mapping maps the pixels without decoding them, and only the pages the tiles touch are read
+        if tifffile is not None:
+            try:
+                return np.asarray(tifffile.memmap(path, mode='r'))
+            except ValueError: # not stored contiguously, decode it instead
+                pass
+        return np.asarray(Image.open(path))
+
+    @classmethod
+    def group_intermediate_coords(cls, pixel_coords, tile, intermediate_files, WIDTH, HEIGHT, img_width, img_height):
+        # Intermediates form a regular grid stored column by column, so the images a tile touches follow from its corners
+        coords = np.array(pixel_coords, dtype=np.int64).reshape(-1, 4)
+        xs, ys = coords[:, 0], coords[:, 1]
+        num_cols, num_rows = -(-WIDTH // img_width), -(-HEIGHT // img_height) # integer ceiling, exact for any image size
+        tile_width, tile_height = tile.width, tile.height
+
+        # Tiles running past the outer edge of the image belong to the last intermediate, where they are padded
+        first_col, last_col = xs // img_width, np.minimum((xs + tile_width - 1) // img_width, num_cols - 1)
+        first_row, last_row = ys // img_height, np.minimum((ys + tile_height - 1) // img_height, num_rows - 1)
+        owner = first_col * num_rows + first_row
+        kind = (last_col > first_col) + 2 * (last_row > first_row) # 0: single, 1: left/right, 2: above/below, 3: four images
+
+        # Group the tiles by owning image and kind, so the images are visited in grid order
+        keys = owner * 4 + kind
+        order = np.argsort(keys, kind='stable') # keeps the original order of the tiles within each group
+        group_keys, group_starts = np.unique(keys[order], return_index=True)
+
+        groups = []
+        for key, group in zip(group_keys.tolist(), np.split(order, group_starts[1:])):
+            index, tile_kind = divmod(key, 4)
+            if tile_kind == 0:
+                files = (intermediate_files[index],)
+            elif tile_kind == 1:
+                files = (intermediate_files[index], intermediate_files[index + num_rows])
+            elif tile_kind == 2:
+                files = (intermediate_files[index], intermediate_files[index + 1])
+            else:
+                files = (intermediate_files[index], intermediate_files[index + 1], intermediate_files[index + num_rows], intermediate_files[index + num_rows + 1])
+            groups.append((len(files), [files + pixel_coords[i] for i in group.tolist()]))
+        return groups
+
+    @classmethod
+    def wms_to_tiles(cls, region, date, xml_path, name, res, tile, tile_date_path, img_format):
+        WIDTH, HEIGHT = region.calculate_width_height(res)
+        wms = TiffDownloader.open_source(TiffDownloader.generate_xml(xml_path, name), date)
+
+        # Resample the WMS source onto the output grid as a virtual dataset, so the full image is never written to disk
+        projwin = [region.bl_coords.x, region.tr_coords.y, region.tr_coords.x, region.bl_coords.y]
+        src = gdal.Translate('', wms, format='VRT', width=WIDTH, height=HEIGHT, projWin=projwin)
+        x_min, x_size, _, y_min, _, y_size = src.GetGeoTransform()
+
+        pixel_coords = TileUtils.getTilingSplitCoords(tile, WIDTH, HEIGHT)
+        tile_names = TileUtils.generate_tile_names_with_coordinates(date, pixel_coords, x_min, x_size, y_min, y_size, tile)
+        tile_paths = TileUtils.generate_tile_paths(tile_date_path, tile_names, img_format)
+
+        TileUtils.generate_tiles_windowed(tile, src, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format)
+
+    @classmethod
+    def generate_tiles_windowed(cls, tile, src, tile_paths, pixel_coords, WIDTH, HEIGHT, img_format):
+        # Read each tile's window straight from the source and write the tile, so only one tile is in memory at a time
+        for (x, y, done_x, done_y) in tqdm(pixel_coords):
+            win_width, win_height = min(tile.width, WIDTH - x), min(tile.height, HEIGHT - y)
+            window = TileUtils.read_pixels(src, x, y, win_width, win_height) # already contiguous, so the encoder takes it without a copy
+            TileUtils.generate_tile(tile, window, tile_paths[(x, y)], win_width, win_height, x, y, done_x, done_y, img_format, inter_x=0, inter_y=0)
+
+    @classmethod
+    def generate_tile(cls, tile, img_arr, tile_path, WIDTH, HEIGHT, x, y, done_x, done_y, img_format, inter_x = None, inter_y = None):
+        tile_width, tile_height, _, handling = tile # unpacked once, as this runs for every tile
         real_x = x
         real_y = y
 
@@ -272,69 +386,89 @@ class TileUtils():
         if inter_y != None:
             real_y = inter_y
         # Tiling past boundaries 
-        if tile.handling == Handling.include_incomplete_tiles and (done_x or done_y):
-            incomplete_tile = img_arr[real_y:min(real_y + tile.height, HEIGHT), real_x:min(real_x + tile.width, WIDTH)]
-            empty_array = np.zeros((tile.height, tile.height, 3), dtype=np.uint8)
-            empty_array[0:incomplete_tile.shape[0], 0:incomplete_tile.shape[1]] = incomplete_tile
-            incomplete_img = Image.fromarray(empty_array)
-            incomplete_img.save(output_path + output_filename + "." + img_format)
+        if handling == Handling.include_incomplete_tiles and (done_x or done_y):
+            incomplete_tile = img_arr[real_y:min(real_y + tile_height, HEIGHT), real_x:min(real_x + tile_width, WIDTH)]
+            if incomplete_tile.shape[:2] == (tile_height, tile_width): # the last tile ends exactly on the boundary, nothing to pad
+                TileUtils.save_tile(incomplete_tile, tile_path, img_format)
+                return
+            empty_array = _tile_canvas((tile_height, tile_width) + incomplete_tile.shape[2:], incomplete_tile.dtype)
+            empty_array[incomplete_tile.shape[0]:] = 0 # only the padding needs clearing, the rest is overwritten
+            empty_array[:incomplete_tile.shape[0], incomplete_tile.shape[1]:] = 0
+            _paste(empty_array, incomplete_tile)
+            TileUtils.save_tile(empty_array, tile_path, img_format)
         else: # Tiling within boundaries
-            tile_array = img_arr[real_y:real_y+tile.height, real_x:real_x+tile.width]
-            tile_img = Image.fromarray(tile_array)
-            tile_img.save(output_path + output_filename + "." + img_format)      
+            tile_array = img_arr[real_y:real_y+tile_height, real_x:real_x+tile_width]
+            TileUtils.save_tile(tile_array, tile_path, img_format)
 
-    @classmethod 
-    def generate_tile_between_two_images(cls, tile, img_arr_left, img_arr_right, tile_date_path, metadata, WIDTH, HEIGHT, x_min, x_size, y_min, y_size, x, y, done_x, done_y, inter_x, inter_y, img_format):
-        # Find which MODIS grid location the current tile fits into
-        output_filename, region = TileUtils.generate_tile_name_with_coordinates(metadata.date, x, x_min, x_size, y, y_min, y_size, tile)
-        output_path = tile_date_path + region.lat_lon_to_modis() + '/'
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
+    @classmethod
+    def encodes_without_gil(cls, img_format):
+        # libjpeg runs without the GIL under both simplejpeg and PIL, so JPEG tiles can be encoded by parallel threads
+        return img_format in ('jpeg', 'jpg')
+
+    @classmethod
+    def save_tile(cls, tile_array, path, img_format):
+        # A tile cut from a wider image is a strided view, copy it once here rather than inside the encoder (no-op when contiguous)
+        tile_array = np.ascontiguousarray(tile_array)
+
+        # simplejpeg and PyTurboJPEG encode straight from the array with libjpeg-turbo, skipping the PIL image object
+        rgb_jpeg = img_format in ('jpeg', 'jpg') and tile_array.ndim == 3 and tile_array.shape[2] == 3
+        if rgb_jpeg and simplejpeg is not None:
+            data = simplejpeg.encode_jpeg(tile_array, quality=JPEG_QUALITY, colorspace='RGB', colorsubsampling='420')
+        elif rgb_jpeg and turbo_jpeg is not None:
+            data = turbo_jpeg.encode(tile_array, quality=JPEG_QUALITY, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+        else:
+            Image.fromarray(tile_array).save(path)
+            return
+        with open(path, 'wb') as f:
+            f.write(data)
 
+    @classmethod 
+    def generate_tile_between_two_images(cls, tile, img_arr_left, img_arr_right, tile_path, WIDTH, HEIGHT, done_x, done_y, inter_x, inter_y, img_format):
         leftover_x = tile.width - (WIDTH - inter_x)
         leftover_y = tile.height - (HEIGHT - inter_y)
+        if leftover_x <= 0 and leftover_y <= 0:
+            return
 
         left_chunk = img_arr_left[inter_y:min(inter_y + tile.height, HEIGHT), inter_x:min(inter_x + tile.width, WIDTH)]
 
-        if leftover_x > 0:
+        # A tile past the outer edge (done_x) lies in the last column, so its leftover is padding rather than the next image
+        if leftover_x > 0 and not done_x: # the right image continues the tile horizontally
             right_chunk = img_arr_right[inter_y:inter_y + tile.height, 0:leftover_x]
-        elif leftover_y > 0:
+            right_y, right_x = 0, left_chunk.shape[1]
+            covered = left_chunk.shape[0] == right_chunk.shape[0] == tile.height and left_chunk.shape[1] + right_chunk.shape[1] == tile.width
+        else: # the second image continues the tile vertically
             right_chunk = img_arr_right[0:leftover_y, inter_x:inter_x + tile.width]
+            right_y, right_x = left_chunk.shape[0], 0
+            covered = left_chunk.shape[1] == right_chunk.shape[1] == tile.width and left_chunk.shape[0] + right_chunk.shape[0] == tile.height
 
-        empty_array = np.zeros((tile.height, tile.height, 3), dtype=np.uint8)
-        empty_array[0:left_chunk.shape[0], 0:left_chunk.shape[1]] = left_chunk
-
-        if leftover_x > 0:
-            empty_array[0:right_chunk.shape[0], left_chunk.shape[1]:left_chunk.shape[1]+right_chunk.shape[1]] = right_chunk
-        elif leftover_y > 0:
-            empty_array[left_chunk.shape[0]:left_chunk.shape[0]+right_chunk.shape[0], 0:right_chunk.shape[1]] = right_chunk
-        if leftover_x > 0 or leftover_y > 0:
-            complete_img = Image.fromarray(empty_array)
-            complete_img.save(output_path + output_filename + "." + img_format)
+        # Only a tile at the outer edge of the image is left partly uncovered by the two chunks and needs clearing
+        empty_array = _tile_canvas((tile.height, tile.width) + left_chunk.shape[2:], left_chunk.dtype)
+        if not covered:
+            empty_array.fill(0)
+        _paste(empty_array, left_chunk)
+        _paste(empty_array, right_chunk, right_y, right_x)
+        TileUtils.save_tile(empty_array, tile_path, img_format)
 
     @classmethod 
-    def generate_tile_between_four_images(cls, tile, img_arr_TL, img_arr_TR, img_arr_BL,img_arr_BR, tile_date_path, metadata, WIDTH, HEIGHT, x_min, x_size, y_min, y_size, x, y, done_x, done_y, inter_x, inter_y, img_format):
-        # Find which MODIS grid location the current tile fits into
-        output_filename, region = TileUtils.generate_tile_name_with_coordinates(metadata.date, x, x_min, x_size, y, y_min, y_size, tile)
-        output_path = tile_date_path + region.lat_lon_to_modis() + '/'
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-
+    def generate_tile_between_four_images(cls, tile, img_arr_TL, img_arr_TR, img_arr_BL,img_arr_BR, tile_path, WIDTH, HEIGHT, done_x, done_y, inter_x, inter_y, img_format):
         leftover_x = tile.width - (WIDTH - inter_x)
         leftover_y = tile.height - (HEIGHT - inter_y)
 
         top_left_chunk = img_arr_TL[inter_y:min(inter_y + tile.height, HEIGHT), inter_x:min(inter_x + tile.width, WIDTH)]
         top_right_chunk = img_arr_TR[inter_y:inter_y + tile.height, 0:leftover_x]
-        bot_left_chunk = img_arr_BL[0:leftover_y, inter_x:inter_x + tile.height]
+        bot_left_chunk = img_arr_BL[0:leftover_y, inter_x:inter_x + tile.width]
         bot_right_chunk = img_arr_BR[0:leftover_y, 0:leftover_x]
-    
-        empty_array = np.zeros((tile.height, tile.height, 3), dtype=np.uint8)
-        empty_array[0:top_left_chunk.shape[0], 0:top_left_chunk.shape[1]] = top_left_chunk
-        empty_array[0:top_right_chunk.shape[0], top_left_chunk.shape[1]:top_left_chunk.shape[1]+top_right_chunk.shape[1]] = top_right_chunk
-        empty_array[top_left_chunk.shape[0]:top_left_chunk.shape[0]+bot_left_chunk.shape[0], 0:bot_left_chunk.shape[1]] = bot_left_chunk
-        empty_array[top_left_chunk.shape[0]:top_left_chunk.shape[0]+bot_right_chunk.shape[0], top_left_chunk.shape[1]:top_left_chunk.shape[1]+bot_right_chunk.shape[1]] = bot_right_chunk
-        complete_img = Image.fromarray(empty_array)
-        complete_img.save(output_path + output_filename + "." + img_format)
+
+        # The quadrants normally cover the whole tile, so the canvas only needs clearing when they don't
+        covered = top_left_chunk.shape[0] + bot_left_chunk.shape[0] == tile.height and top_left_chunk.shape[1] + top_right_chunk.shape[1] == tile.width
+        empty_array = _tile_canvas((tile.height, tile.width) + top_left_chunk.shape[2:], top_left_chunk.dtype)
+        if not covered:
+            empty_array.fill(0)
+        _paste(empty_array, top_left_chunk)
+        _paste(empty_array, top_right_chunk, 0, top_left_chunk.shape[1])
+        _paste(empty_array, bot_left_chunk, top_left_chunk.shape[0], 0)
+        _paste(empty_array, bot_right_chunk, top_left_chunk.shape[0], top_left_chunk.shape[1])
+        TileUtils.save_tile(empty_array, tile_path, img_format)
 
     @classmethod
     def generate_tile_name_with_coordinates(cls, date, x, x_min, x_size, y, y_min, y_size, tile):
@@ -346,67 +480,91 @@ class TileUtils():
         return filename, Rectangle(Coordinate((bl_y, bl_x)), Coordinate((tr_y, tr_x)))
 
     @classmethod
-    def img_to_intermediate_images(cls, tiff_path, tile, width, height, date, img_format):
+    def generate_tile_names_with_coordinates(cls, date, pixel_coords, x_min, x_size, y_min, y_size, tile):
+        # Longitudes only depend on a tile's column and latitudes on its row, so they are computed once per column and per row
+        coords = np.array(pixel_coords, dtype=np.float64).reshape(-1, 4)
+        col_xs, col_index = np.unique(coords[:, 0], return_inverse=True)
+        row_ys, row_index = np.unique(coords[:, 1], return_inverse=True)
+        tr_xs, bl_xs = (col_xs * x_size + x_min).tolist(), ((col_xs + tile.width) * x_size + x_min).tolist()
+        tr_ys, bl_ys = ((row_ys + tile.height) * y_size + y_min).tolist(), (row_ys * y_size + y_min).tolist()
+
+        # The same goes for their formatting, each tile name is then joined from its column's and row's strings
+        tr_x_strs, bl_x_strs = [f'{round(v, 4):09}' for v in tr_xs], [f'{round(v, 4):09}' for v in bl_xs]
+        tr_y_strs, bl_y_strs = [f'{round(v, 4):08}' for v in tr_ys], [f'{round(v, 4):08}' for v in bl_ys]
+        prefix = "{}_".format(date)
+
+        tile_names = {}
+        for (x, y, done_x, done_y), col, row in zip(pixel_coords, col_index.tolist(), row_index.tolist()):
+            filename = prefix + ",".join((tr_y_strs[row], tr_x_strs[col], bl_y_strs[row], bl_x_strs[col]))
+            tile_names[(x, y)] = (filename, Rectangle(Coordinate((bl_ys[row], bl_xs[col])), Coordinate((tr_ys[row], tr_xs[col]))))
+        return tile_names
+
+    @classmethod
+    def generate_tile_paths(cls, tile_date_path, tile_names, img_format):
+        # Sort each tile into the MODIS grid location holding its bottom left corner, creating each directory once
+        regions = [region for _, region in tile_names.values()]
+        cells = Rectangle.lat_lon_to_modis_cells([region.bl_coords.x for region in regions], [region.bl_coords.y for region in regions])
+        tile_paths = {}
+        for (coords, (filename, _)), cell in zip(tile_names.items(), cells):
+            tile_paths[coords] = os.path.join(tile_date_path, cell, "{}.{}".format(filename, img_format))
+        for directory in {os.path.dirname(path) for path in tile_paths.values()}:
+            os.makedirs(directory, exist_ok=True)
+        return tile_paths
+
+    @classmethod
+    def intermediate_length(cls, length, tile_length):
+        # Split evenly into the fewest pieces PIL can open, the last piece is then at most a pixel per piece shorter than the others
+        num_pieces = -(-length // MAX_INTERMEDIATE_LENGTH)
+        piece_length = -(-length // num_pieces)
+
+        # Every piece, the last one included, must hold a whole tile so that no tile spans more than two pieces
+        if length - (num_pieces - 1) * piece_length < tile_length:
+            raise argparse.ArgumentTypeError("Tiling dimensions too large to split the image into intermediate images")
+        return piece_length
+
+    @classmethod
+    def img_to_intermediate_images(cls, tiff_path, tile, width, height, date, img_format, mp=True):
         output_dir = os.path.join(os.path.dirname(tiff_path), 'inter_{}'.format(date))
-        os.mkdir(output_dir)
+        os.makedirs(output_dir, exist_ok=True) # may be left over by an interrupted run
 
-        max_img_width = min(width, MAX_INTERMEDIATE_LENGTH)
-        max_img_height = min(height, MAX_INTERMEDIATE_LENGTH)
-        
         # Find largest possible intermediate image sizes
-        while ((max_img_width != width) and (((width / max_img_width) % 1) * max_img_width  < tile.width)):
-            max_img_width -= 256
-
-        while ((max_img_height != height) and (((height / max_img_height)  % 1) * max_img_height < tile.height)):
-            max_img_height -= 256
+        max_img_width = TileUtils.intermediate_length(width, tile.width)
+        max_img_height = TileUtils.intermediate_length(height, tile.height)
 
-        original_max_img_width = max_img_width   # Store these values in another variable so they can be returned
-        original_max_img_height = max_img_height  
-        
         print(width, height, max_img_width, max_img_height, width / max_img_width, height / max_img_height )
-        # LOOP THOUGH AND GET THE DATA TO GENERATE THE INTERMEDIATE TILES
-        width_current = 0
-        done_width = False
-        index = 0
-        intermediate_data = []
-        while width_current < width and not done_width:
-            if width - width_current < max_img_width:
-                max_img_width = width - width_current
-                done_width = True
-            height_current = 0
-            done_height = False
-            max_img_height = original_max_img_height
-            while height_current < height and not done_height:
-                if height - height_current < max_img_height: 
-                    max_img_height = height - height_current
-                    done_height = True
-                intermediate_data.append((width_current, height_current, max_img_width, max_img_height, index))
-                height_current += max_img_height
-                index += 1
-            width_current += max_img_width
-        
-        # Sequentially generate intermediate tiles
-        for (width_current, height_current, width_length, height_length, index) in intermediate_data:
-            TileUtils.generate_intermediate_image(output_dir, width_current, height_current, width_length, height_length, tiff_path, index, img_format)
-        
-        # Utilize multithreading to generate the intermediate tiles
-        """
-        num_cores = multiprocessing.cpu_count()
-        pool = Pool(num_cores)
-        
-        print("Generating {} intermediate images using {} threads".format(len(intermediate_data), num_cores))
-        for (width_current, height_current, width_length, height_length, index) in intermediate_data:
-            pool.apply_async(TileUtils.generate_intermediate_image, args=(output_dir, width_current, height_current, width_length, height_length, tiff_path, index, img_format))
-        
-        pool.close()
-        pool.join()
-        """
+        # Lay the intermediates out column by column, the last column and row being clipped to the image
+        xs, ys = np.meshgrid(np.arange(0, width, max_img_width), np.arange(0, height, max_img_height), indexing='ij')
+        widths, heights = np.minimum(xs + max_img_width, width) - xs, np.minimum(ys + max_img_height, height) - ys
+        intermediate_data = list(zip(xs.ravel().tolist(), ys.ravel().tolist(), widths.ravel().tolist(), heights.ravel().tolist(), range(xs.size)))
+
+        # Intermediates completed by an interrupted run are kept, found with a single directory listing
+        existing = set(os.listdir(output_dir))
+        intermediate_data = [data for data in intermediate_data if TileUtils.intermediate_filename(*data, img_format) not in existing]
+
+        if mp and intermediate_data:
+            # Each intermediate is an independent window of the original, so they are cut in parallel, every worker opening the original itself
+            print("Generating {} intermediate images using {} processes".format(len(intermediate_data), min(len(intermediate_data), os.cpu_count())))
+            with ProcessPoolExecutor(max_workers=min(len(intermediate_data), os.cpu_count())) as executor:
+                futures = [executor.submit(TileUtils.generate_intermediate_image, output_dir, width_current, height_current, width_length, height_length, tiff_path, index, img_format) for (width_current, height_current, width_length, height_length, index) in intermediate_data]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    future.result()
+        else:
+            # Sequentially generate intermediate tiles
+            for (width_current, height_current, width_length, height_length, index) in intermediate_data:
+                TileUtils.generate_intermediate_image(output_dir, width_current, height_current, width_length, height_length, tiff_path, index, img_format)
 
-        return output_dir, original_max_img_width, original_max_img_height
+        _open_original.cache_clear() # release the original, the pool workers have exited with theirs
+        return output_dir, max_img_width, max_img_height
+
+    @classmethod 
+    def intermediate_filename(cls, width_current, height_current, width_length, height_length, index, img_format):
+        return "{}_{}_{}_{}_{}.{}".format(str(index).zfill(5), width_current, height_current, width_current + width_length, height_current + height_length, img_format)
 
     @classmethod 
     def generate_intermediate_image(cls, output_dir, width_current, height_current, width_length, height_length, tiff_path, index, img_format):
-        output_path = os.path.join(output_dir, "{}_{}_{}_{}_{}".format(str(index).zfill(5), width_current, height_current, width_current + width_length, height_current + height_length))
-        command = "gdal_translate -of {of} -srcwin --config GDAL_PAM_ENABLED NO {x}, {y}, {t_width}, {t_height} {tif_path} {out_path}.{ext}".format(of=img_format.upper(), x=str(width_current), y=str(height_current), t_width=width_length, t_height=height_length, tif_path=tiff_path, out_path=output_path, ext=img_format)
-        os.system(command)
+        output_path = os.path.join(output_dir, TileUtils.intermediate_filename(width_current, height_current, width_length, height_length, index, img_format))
+        # Cut the window in process, rather than launching a gdal_translate that re-opens the original for every intermediate
+        src = _open_original(tiff_path)
+        gdal.Translate(output_path + '.tmp', src, format='GTiff' if img_format == 'tif' else img_format.upper(), srcWin=[width_current, height_current, width_length, height_length])
+        os.replace(output_path + '.tmp', output_path) # only complete intermediates ever carry their final name
         
\ No newline at end of file